@@ -0,0 +1,196 @@
+"""ASGI entry point (e.g. `uvicorn asgi:app`).
+
+/stream/<file_id> and /results/<file_id> are served by coroutines, so an open
+results page costs a task waiting on Redis pub/sub (or on an in-memory wake-up)
+instead of a worker thread. Every other route is handed to the Flask app.
+"""
+
+import asyncio
+from collections import defaultdict
+
+import redis.asyncio
+from asgiref.wsgi import WsgiToAsgi
+from flask import render_template
+
+import main
+from main import app as flask_app, STREAM_DONE, STREAM_KEEPALIVE
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+_redis = None
+_loop = None
+_waiters = defaultdict(set)  # file_id -> events of coroutines waiting on that stream
+
+
+def redis_client():
+    global _redis
+    if _redis is None:
+        _redis = redis.asyncio.Redis(host='localhost', port=6379, db=0, decode_responses=False)
+    return _redis
+
+
+def _wake(file_id):
+    for event in _waiters.get(file_id, ()):
+        event.set()
+
+
+def _on_append(file_id):
+    # Runs in the grader threads; hop onto the event loop
+    if _loop is not None and file_id in _waiters:
+        _loop.call_soon_threadsafe(_wake, file_id)
+
+
+main.stream_observers.append(_on_append)
+
+
+async def get_stream_messages(file_id, start_index):
+    if main.USE_REDIS:
+        messages = await redis_client().lrange(f"stream:{file_id}:log", start_index, -1)
+        return [msg.decode('utf-8') for msg in messages]
+    return main.get_stream_messages(file_id, start_index)
+
+
+class AsyncStreamListener:
+    """Coroutine counterpart of main.StreamListener."""
+
+    def __init__(self, file_id):
+        self.file_id = file_id
+        self.pubsub = None
+        self.event = None
+
+    async def open(self):
+        if main.USE_REDIS:
+            self.pubsub = redis_client().pubsub(ignore_subscribe_messages=True)
+            await self.pubsub.subscribe(f"stream:{self.file_id}:new")
+        else:
+            self.event = asyncio.Event()
+            _waiters[self.file_id].add(self.event)
+
+    async def wait(self, last_index, timeout):
+        """Wait up to timeout seconds for messages past last_index; False if nothing arrived."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        if self.pubsub is not None:
+            while await self.pubsub.get_message(timeout=max(deadline - loop.time(), 0)) is None:
+                if loop.time() >= deadline:
+                    return False
+            while await self.pubsub.get_message(timeout=0) is not None:
+                pass
+            return True
+
+        while len(main.get_stream_messages(self.file_id, last_index)) == 0:
+            self.event.clear()
+            # Re-check after clearing so an append in between is not missed
+            if main.get_stream_messages(self.file_id, last_index):
+                break
+            try:
+                await asyncio.wait_for(self.event.wait(), max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def close(self):
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+        elif self.event is not None:
+            waiters = _waiters.get(self.file_id)
+            if waiters is not None:
+                waiters.discard(self.event)
+                if not waiters:
+                    del _waiters[self.file_id]
+
+
+async def send_text(send, status, content_type, body):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type)]})
+    await send({"type": "http.response.body", "body": body.encode()})
+
+
+async def results(scope, receive, send, file_id):
+    with flask_app.app_context():
+        body = render_template('results.html', file_id=file_id)
+    await send_text(send, 200, b"text/html; charset=utf-8", body)
+
+
+async def stream(scope, receive, send, file_id):
+    headers = dict(scope["headers"])
+    try:
+        last_index = max(int(headers.get(b"last-event-id", b"0")), 0)
+    except ValueError:
+        last_index = 0
+
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")]})
+
+    async def event(text):
+        await send({"type": "http.response.body", "body": text.encode(), "more_body": True})
+
+    async def event_stream(last_index):
+        listener = AsyncStreamListener(file_id)
+        await listener.open()
+        try:
+            if last_index and (await get_stream_messages(file_id, last_index - 1))[:1] == [STREAM_DONE]:
+                await event("event: end\ndata: \n\n")
+                return
+            while True:
+                updates = await get_stream_messages(file_id, last_index)
+                for update in updates:
+                    last_index += 1
+                    await event(f"id: {last_index}\ndata: {update}\n\n")
+
+                if STREAM_DONE in updates:
+                    await event("event: end\ndata: \n\n")
+                    break
+
+                if not updates and not await listener.wait(last_index, STREAM_KEEPALIVE):
+                    await event(": keepalive\n\n")
+        except Exception as e:
+            await event(f"data: Erro na stream: {str(e)}\n\n")
+        finally:
+            await listener.close()
+
+    async def disconnected():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    streaming = asyncio.ensure_future(event_stream(last_index))
+    watching = asyncio.ensure_future(disconnected())
+    done, _ = await asyncio.wait({streaming, watching}, return_when=asyncio.FIRST_COMPLETED)
+    if streaming in done:
+        watching.cancel()
+        await send({"type": "http.response.body", "body": b""})
+    else:
+        # The client went away; stop waiting on its stream
+        streaming.cancel()
+        try:
+            await streaming
+        except asyncio.CancelledError:
+            pass
+
+
+async def lifespan(receive, send):
+    global _loop
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            _loop = asyncio.get_running_loop()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _redis is not None:
+                await _redis.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    global _loop
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] == "http":
+        _loop = _loop or asyncio.get_running_loop()
+        parts = scope["path"].strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "stream" and scope["method"] == "GET":
+            return await stream(scope, receive, send, parts[1])
+        if len(parts) == 2 and parts[0] == "results" and scope["method"] == "GET":
+            return await results(scope, receive, send, parts[1])
+    await wsgi_app(scope, receive, send)
@@ -7,7 +7,7 @@ functions.
 """
 
 import sys
-from collections import deque
+from collections import OrderedDict, deque
 
 from utils import *
 
@@ -73,7 +73,13 @@ class Node:
     the total path_cost (also known as g) to reach the node. Other functions
     may add an f and h value; see best_first_graph_search and astar_search for
     an explanation of how the f and h values are handled. You will not need to
-    subclass this class."""
+    subclass this class.
+
+    The attributes live in __slots__, so a node carries no per-instance dict
+    unless some other attribute is set on it; f and h are unset until a search
+    assigns them."""
+
+    __slots__ = ('state', 'parent', 'action', 'path_cost', 'depth', 'f', 'h', '__dict__')
 
     def __init__(self, state, parent=None, action=None, path_cost=0):
         """Create a search tree Node, derived from a parent by an action."""
@@ -96,6 +102,12 @@ class Node:
         return [self.child_node(problem, action)
                 for action in problem.actions(self.state)]
 
+    def iter_expand(self, problem):
+        """Yield the nodes reachable in one step from this node, each one only
+        when it is asked for, so unvisited children cost no result() call."""
+        for action in problem.actions(self.state):
+            yield self.child_node(problem, action)
+
     def child_node(self, problem, action):
         """[Figure 3.10]"""
         next_state = problem.result(self.state, action)
@@ -104,15 +116,21 @@ class Node:
 
     def solution(self):
         """Return the sequence of actions to go from the root to this node."""
-        return [node.action for node in self.path()[1:]]
+        node, actions = self, []
+        while node.parent is not None:
+            actions.append(node.action)
+            node = node.parent
+        actions.reverse()
+        return actions
 
     def path(self):
         """Return a list of nodes forming the path from the root to this node."""
         node, path_back = self, []
-        while node:
+        while node is not None:
             path_back.append(node)
             node = node.parent
-        return list(reversed(path_back))
+        path_back.reverse()
+        return path_back
 
     # We want for a queue of nodes in breadth_first_graph_search or
     # astar_search to have no duplicated states, so we treat nodes
@@ -223,15 +241,45 @@ def depth_first_graph_search(problem):
     If two paths reach a state, only use the first one.
     """
     frontier = [(Node(problem.initial))]  # Stack
+    frontier_states = {problem.initial}  # states on the stack, so membership is a hash lookup
 
     explored = set()
     while frontier:
         node = frontier.pop()
+        frontier_states.discard(node.state)
         if problem.goal_test(node.state):
             return node
         explored.add(node.state)
-        frontier.extend(child for child in node.expand(problem)
-                        if child.state not in explored and child not in frontier)
+        for child in node.expand(problem):
+            if child.state not in explored and child.state not in frontier_states:
+                frontier.append(child)
+                frontier_states.add(child.state)
+    return None
+
+
+def lazy_depth_first_graph_search(problem):
+    """Depth-first graph search that keeps a stack of child iterators instead
+    of a stack of nodes. A node's children are generated one at a time, when
+    the search comes back to it, so siblings of a branch that reaches a goal
+    are never built. Unlike depth_first_graph_search, children are visited in
+    the order problem.actions yields them, and states are goal-tested and
+    marked as reached as soon as they are generated."""
+    node = Node(problem.initial)
+    if problem.goal_test(node.state):
+        return node
+    reached = {node.state}
+    stack = [node.iter_expand(problem)]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+            continue
+        if child.state in reached:
+            continue
+        if problem.goal_test(child.state):
+            return child
+        reached.add(child.state)
+        stack.append(child.iter_expand(problem))
     return None
 
 
@@ -245,15 +293,19 @@ def breadth_first_graph_search(problem):
     if problem.goal_test(node.state):
         return node
     frontier = deque([node])
+    frontier_states = {node.state}  # states in the queue, so membership is a hash lookup
     explored = set()
     while frontier:
         node = frontier.popleft()
+        frontier_states.discard(node.state)
         explored.add(node.state)
-        for child in node.expand(problem):
-            if child.state not in explored and child not in frontier:
+        # Children are goal-tested as they are generated; the ones after a goal are never built
+        for child in node.iter_expand(problem):
+            if child.state not in explored and child.state not in frontier_states:
                 if problem.goal_test(child.state):
                     return child
                 frontier.append(child)
+                frontier_states.add(child.state)
     return None
 
 
@@ -282,8 +334,7 @@ def best_first_graph_search(problem, f, display=False):
                 frontier.append(child)
             elif child in frontier:
                 if f(child) < frontier[child]:
-                    del frontier[child]
-                    frontier.append(child)
+                    frontier.update(child)
     return None
 
 
@@ -292,34 +343,118 @@ def uniform_cost_search(problem, display=False):
     return best_first_graph_search(problem, lambda node: node.path_cost, display)
 
 
-def depth_limited_search(problem, limit=50):
-    """[Figure 3.17]"""
+class TranspositionTable:
+    """Bounded memory of what a depth-limited search found below each state,
+    shared by the iterations of iterative_deepening_search.
 
-    def recursive_dls(node, problem, limit):
-        if problem.goal_test(node.state):
-            return node
-        elif limit == 0:
-            return 'cutoff'
-        else:
-            cutoff_occurred = False
-            for child in node.expand(problem):
-                result = recursive_dls(child, problem, limit - 1)
-                if result == 'cutoff':
-                    cutoff_occurred = True
-                elif result is not None:
-                    return result
-            return 'cutoff' if cutoff_occurred else None
-
-    # Body of depth_limited_search:
-    return recursive_dls(Node(problem.initial), problem, limit)
-
-
-def iterative_deepening_search(problem):
-    """[Figure 3.18]"""
-    for depth in range(sys.maxsize):
-        result = depth_limited_search(problem, depth)
-        if result != 'cutoff':
-            return result
+    A state explored with `remaining` levels to go maps to (remaining, result).
+    A 'cutoff' result answers any later visit with at most that many levels
+    left; a None result means the state's whole subtree holds no goal, so it
+    answers every later visit. The least recently used entries are dropped
+    beyond maxsize."""
+
+    MISS = object()
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def lookup(self, state, remaining):
+        """The known result for state with remaining levels, or MISS."""
+        entry = self.entries.get(state)
+        if entry is None:
+            return self.MISS
+        known_remaining, result = entry
+        if result is not None and remaining > known_remaining:
+            return self.MISS
+        self.entries.move_to_end(state)
+        return result
+
+    def store(self, state, remaining, result):
+        entry = self.entries.get(state)
+        if entry is not None and entry[1] is not None and entry[0] > remaining:
+            remaining = entry[0]
+        self.entries[state] = (remaining, result)
+        self.entries.move_to_end(state)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+def _depth_limited_search(problem, limit, table, counts, seen_depth):
+    """Body of depth_limited_search with an explicit stack of
+    [node, child iterator, remaining levels, cutoff occurred] frames.
+    Children at depth <= seen_depth are counted as regenerated."""
+    root = Node(problem.initial)
+    if problem.goal_test(root.state):
+        return root
+    if limit == 0:
+        return 'cutoff'
+    stack = [[root, root.iter_expand(problem), limit, False]]
+    result = None
+    while stack:
+        frame = stack[-1]
+        child = next(frame[1], None)
+        if child is None:
+            # Every child of this node is done: report to its parent
+            stack.pop()
+            result = 'cutoff' if frame[3] else None
+            if table is not None:
+                table.store(frame[0].state, frame[2], result)
+            if stack and result == 'cutoff':
+                stack[-1][3] = True
+            continue
+
+        counts['generated'] += 1
+        if child.depth <= seen_depth:
+            counts['regenerated'] += 1
+        remaining = frame[2] - 1
+        if table is not None:
+            known = table.lookup(child.state, remaining)
+            if known is not table.MISS:
+                counts['pruned'] += 1
+                if known == 'cutoff':
+                    frame[3] = True
+                continue
+        if problem.goal_test(child.state):
+            return child
+        if remaining == 0:
+            frame[3] = True
+            continue
+        stack.append([child, child.iter_expand(problem), remaining, False])
+    return result
+
+
+def depth_limited_search(problem, limit=50, stats=None):
+    """[Figure 3.17]
+    Returns a goal node, 'cutoff' if the limit stopped the search, or None.
+    Uses an explicit stack, so the limit is not bounded by Python's recursion
+    limit. If a stats dict is given, the counts of generated nodes are added to it."""
+    counts = {'generated': 0, 'regenerated': 0, 'pruned': 0}
+    result = _depth_limited_search(problem, limit, None, counts, -1)
+    if stats is not None:
+        for key, value in counts.items():
+            stats[key] = stats.get(key, 0) + value
+    return result
+
+
+def iterative_deepening_search(problem, table_size=0, stats=None):
+    """[Figure 3.18]
+    With table_size > 0, a TranspositionTable of that many states is kept
+    across iterations and subtrees already known to be goalless at the
+    remaining depth are not expanded again. If a stats dict is given it
+    receives the number of iterations and of generated, regenerated (already
+    generated by an earlier iteration) and pruned nodes."""
+    table = TranspositionTable(table_size) if table_size > 0 else None
+    counts = {'iterations': 0, 'generated': 0, 'regenerated': 0, 'pruned': 0}
+    try:
+        for depth in range(sys.maxsize):
+            counts['iterations'] += 1
+            result = _depth_limited_search(problem, depth, table, counts, depth - 1)
+            if result != 'cutoff':
+                return result
+    finally:
+        if stats is not None:
+            stats.update(counts)
 
 
 # ______________________________________________________________________________
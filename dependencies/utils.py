@@ -5,6 +5,7 @@ import collections
 import collections.abc
 import functools
 import heapq
+import itertools
 import operator
 import os.path
 import random
@@ -410,13 +411,15 @@ def memoize(fn, slot=None, maxsize=32):
     If slot is specified, store result in that slot of first argument.
     If slot is false, use lru_cache for caching the values."""
     if slot:
+        missing = object()
+
         def memoized_fn(obj, *args):
-            if hasattr(obj, slot):
-                return getattr(obj, slot)
-            else:
+            # One attribute lookup; an unset __slots__ entry reads as missing too
+            val = getattr(obj, slot, missing)
+            if val is missing:
                 val = fn(obj, *args)
                 setattr(obj, slot, val)
-                return val
+            return val
     else:
         @functools.lru_cache(maxsize=maxsize)
         def memoized_fn(*args):
@@ -724,10 +727,22 @@ class PriorityQueue:
     order) is returned first.
     If order is 'min', the item with minimum f(x) is
     returned first; if order is 'max', then it is the item with maximum f(x).
-    Also supports dict-like lookup."""
+    Also supports dict-like lookup.
+
+    The heap holds [f(x), counter, x] entries, and a dict maps every item to its
+    live entries, so membership, lookup and deletion cost O(1) and O(log n)
+    instead of a scan. Deleted entries stay in the heap, marked as removed, until
+    they are popped or the heap is compacted. Items with equal f(x) are returned
+    in insertion order. Unhashable items are kept in a list that is scanned."""
+
+    _REMOVED = object()
 
     def __init__(self, order='min', f=lambda x: x):
         self.heap = []
+        self.entries = {}  # item -> its live heap entries, oldest first
+        self.unhashable = []  # live entries whose item cannot be a dict key
+        self.counter = itertools.count()
+        self.size = 0
         if order == 'min':
             self.f = f
         elif order == 'max':  # now item with max f(x)
@@ -735,9 +750,33 @@ class PriorityQueue:
         else:
             raise ValueError("Order must be either 'min' or 'max'.")
 
+    def _live_entries(self, key):
+        """The list holding key's live entries, or None if key is not present."""
+        try:
+            return self.entries.get(key)
+        except TypeError:
+            entries = [entry for entry in self.unhashable if entry[2] == key]
+            return entries or None
+
+    def _forget(self, entry):
+        try:
+            entries = self.entries[entry[2]]
+        except TypeError:
+            self.unhashable.remove(entry)
+            return
+        entries.remove(entry)
+        if not entries:
+            del self.entries[entry[2]]
+
     def append(self, item):
         """Insert item at its correct position."""
-        heapq.heappush(self.heap, (self.f(item), item))
+        entry = [self.f(item), next(self.counter), item]
+        try:
+            self.entries.setdefault(item, []).append(entry)
+        except TypeError:
+            self.unhashable.append(entry)
+        heapq.heappush(self.heap, entry)
+        self.size += 1
 
     def extend(self, items):
         """Insert each item in items at its correct position."""
@@ -747,34 +786,50 @@ class PriorityQueue:
     def pop(self):
         """Pop and return the item (with min or max f(x) value)
         depending on the order."""
-        if self.heap:
-            return heapq.heappop(self.heap)[1]
-        else:
-            raise Exception('Trying to pop from empty PriorityQueue.')
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            if entry[2] is not self._REMOVED:
+                self._forget(entry)
+                self.size -= 1
+                return entry[2]
+        raise Exception('Trying to pop from empty PriorityQueue.')
+
+    def update(self, item):
+        """Give the first entry equal to item the value f(item), e.g. to decrease its key,
+        and store item in its place. Inserts item if it is not present."""
+        if item in self:
+            del self[item]
+        self.append(item)
 
     def __len__(self):
         """Return current capacity of PriorityQueue."""
-        return len(self.heap)
+        return self.size
 
     def __contains__(self, key):
         """Return True if the key is in PriorityQueue."""
-        return any([item == key for _, item in self.heap])
+        return self._live_entries(key) is not None
 
     def __getitem__(self, key):
         """Returns the first value associated with key in PriorityQueue.
         Raises KeyError if key is not present."""
-        for value, item in self.heap:
-            if item == key:
-                return value
-        raise KeyError(str(key) + " is not in the priority queue")
+        entries = self._live_entries(key)
+        if entries is None:
+            raise KeyError(str(key) + " is not in the priority queue")
+        return entries[0][0]
 
     def __delitem__(self, key):
         """Delete the first occurrence of key."""
-        try:
-            del self.heap[[item == key for _, item in self.heap].index(True)]
-        except ValueError:
+        entries = self._live_entries(key)
+        if entries is None:
             raise KeyError(str(key) + " is not in the priority queue")
-        heapq.heapify(self.heap)
+        entry = entries[0]
+        self._forget(entry)
+        entry[2] = self._REMOVED
+        self.size -= 1
+        # Drop the removed entries once they make up most of the heap
+        if len(self.heap) > 64 and self.size < len(self.heap) // 2:
+            self.heap = [entry for entry in self.heap if entry[2] is not self._REMOVED]
+            heapq.heapify(self.heap)
 
 
 # ______________________________________________________________________________
@@ -1,23 +1,188 @@
 from flask import Flask, request, redirect, url_for, render_template, Response
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 import subprocess
 import threading
 import uuid
 import time
-import glob
 import json
 import shutil
 import ast
 import sqlite3
-from datetime import datetime
+import queue
+from datetime import datetime, timezone
 import resource
 import redis
 import pickle
+import hashlib
+import difflib
+import math
+import signal
+from warm_pool import WarmPool, WarmPoolUnavailable, communicate, kill_group, usage_from_rusage
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, Future
 
 app = Flask(__name__)
+# Reverse proxies in front of the app whose X-Forwarded-For may be believed. With the default of 0
+# the header is ignored, so a student cannot pose as someone else to dodge the per-submitter queue limit.
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
 UPLOAD_FOLDER = "uploads"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+MEMORY_LIMIT = 10 * 1024 * 1024 * 1024  # 10 GB address space limit for user scripts
+
+def physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 8 * 1024 * 1024 * 1024
+
+# Memory the grader may hand out to test processes and the share each running test is assumed to use
+MEMORY_BUDGET = int(os.environ.get("GRADER_MEMORY_BUDGET", physical_memory()))
+TEST_MEMORY_RESERVE = int(os.environ.get("TEST_MEMORY_RESERVE", 512 * 1024 * 1024))
+
+# Maximum number of test cases running at once on this machine, shared by every submission
+TEST_WORKERS = int(os.environ.get("TEST_WORKERS",
+                                  max(1, min(os.cpu_count() or 1, MEMORY_BUDGET // TEST_MEMORY_RESERVE))))
+# Web server processes grading side by side (gunicorn -w N). Each one runs its own pool, so the
+# cap is split evenly between them, with at least one test per process. Defaults to
+# WEB_CONCURRENCY, which gunicorn also reads as its worker count.
+GRADER_PROCESSES = max(1, int(os.environ.get("GRADER_PROCESSES", os.environ.get("WEB_CONCURRENCY", 1))))
+PROCESS_TEST_WORKERS = max(1, TEST_WORKERS // GRADER_PROCESSES)
+test_executor = ThreadPoolExecutor(max_workers=PROCESS_TEST_WORKERS, thread_name_prefix="test-runner")
+
+# Interpreters with search, utils and numpy already imported; submissions are forked from them.
+# Set WARM_POOL_SIZE=0 to always start a fresh python3 per test.
+WARM_POOL_SIZE = int(os.environ.get("WARM_POOL_SIZE", 2))
+try:
+    warm_pool = WarmPool(WARM_POOL_SIZE, "dependencies", MEMORY_LIMIT) if WARM_POOL_SIZE > 0 else None
+except (OSError, WarmPoolUnavailable):
+    warm_pool = None
+
+# Optional cgroup v2 sandbox: every test runs in its own cgroup under CGROUP_ROOT, whose
+# memory.max, cpu.max and pids.max replace the address space rlimit. CGROUP_ROOT must be a
+# delegated cgroup2 directory writable by the grader that the grader itself does not live in.
+CGROUP_ROOT = os.environ.get("CGROUP_ROOT", "")
+CGROUP_MEMORY_MAX = os.environ.get("CGROUP_MEMORY_MAX", str(TEST_MEMORY_RESERVE))
+CGROUP_CPU_MAX = os.environ.get("CGROUP_CPU_MAX", "100000 100000")  # quota and period in µs: one CPU
+CGROUP_PIDS_MAX = os.environ.get("CGROUP_PIDS_MAX", "64")
+
+class CgroupSandbox:
+    """One cgroup per test run, created before the child starts and removed once it is reaped."""
+
+    def __init__(self, root):
+        self.path = os.path.join(root, f"run-{uuid.uuid4().hex}")
+        os.mkdir(self.path)
+        try:
+            self._write("memory.max", CGROUP_MEMORY_MAX)
+            # No swap, so hitting memory.max means an OOM kill instead of thrashing
+            self._write("memory.swap.max", "0", required=False)
+            self._write("cpu.max", CGROUP_CPU_MAX)
+            self._write("pids.max", CGROUP_PIDS_MAX)
+        except OSError:
+            self.remove()
+            raise
+
+    def _write(self, name, value, required=True):
+        try:
+            with open(os.path.join(self.path, name), "w") as f:
+                f.write(value)
+        except OSError:
+            if required:
+                raise
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def oom_killed(self):
+        events = self._read("memory.events") or ""
+        for line in events.splitlines():
+            key, _, value = line.partition(" ")
+            if key == "oom_kill":
+                return int(value) > 0
+        return False
+
+    def peak_memory(self):
+        """memory.peak in bytes, or None on kernels older than 5.19."""
+        peak = self._read("memory.peak")
+        return int(peak) if peak else None
+
+    def remove(self):
+        # Kill anything the script left behind; the directory can only go once it is empty
+        self._write("cgroup.kill", "1", required=False)
+        for _ in range(100):
+            try:
+                os.rmdir(self.path)
+                return
+            except FileNotFoundError:
+                return
+            except OSError:
+                time.sleep(0.01)
+        app.logger.warning("Could not remove cgroup %s", self.path)
+
+def enable_cgroups(root):
+    """Turn on the controllers the sandboxes need; False when cgroup v2 is not usable at root."""
+    if not root:
+        return False
+    try:
+        with open(os.path.join(root, "cgroup.controllers")) as f:
+            available = f.read().split()
+        missing = {"memory", "cpu", "pids"} - set(available)
+        if missing:
+            raise OSError(f"controllers not delegated: {' '.join(sorted(missing))}")
+        with open(os.path.join(root, "cgroup.subtree_control"), "w") as f:
+            f.write("+memory +cpu +pids")
+    except OSError as e:
+        app.logger.warning("cgroup sandbox disabled, falling back to rlimits: %s", e)
+        return False
+    return True
+
+USE_CGROUPS = enable_cgroups(CGROUP_ROOT)
+
+# "wall" enforces timeouts.json as wall-clock limits. "cpu" enforces them as CPU time through
+# RLIMIT_CPU, so a test descheduled on a busy grader is not failed; a wall-clock limit of
+# CPU_TIMEOUT_WALL_FACTOR times the timeout still catches scripts that sleep or block.
+TIMING_MODE = os.environ.get("TIMING_MODE", "wall")
+CPU_TIMEOUT_WALL_FACTOR = float(os.environ.get("CPU_TIMEOUT_WALL_FACTOR", 3))
+
+def parse_cpu_list(spec):
+    """Cores from a cpuset-style list such as '2-5,7'; 'all' means every core we may run on."""
+    if spec == "all":
+        return sorted(os.sched_getaffinity(0))
+    cores = set()
+    for part in spec.split(","):
+        first, _, last = part.strip().partition("-")
+        cores.update(range(int(first), int(last or first) + 1))
+    return sorted(cores)
+
+class CorePool:
+    """Hands out one dedicated core per running test; acquire() blocks until a core is free."""
+
+    def __init__(self, cores):
+        self.free = deque(cores)
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.free)
+            return self.free.popleft()
+
+    def release(self, core):
+        with self.cond:
+            self.free.append(core)
+            self.cond.notify()
+
+# Pin each test process to its own core, e.g. PIN_CORES=all or PIN_CORES=1-7 to keep core 0 for the grader.
+# The cores are handed out per process, so with GRADER_PROCESSES > 1 give each process its own list.
+PIN_CORES = os.environ.get("PIN_CORES", "")
+core_pool = CorePool(parse_cpu_list(PIN_CORES)) if PIN_CORES else None
+
 # Redis connection for shared state across workers
 try:
     redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=False)
@@ -28,14 +193,25 @@ except (redis.ConnectionError, redis.TimeoutError, ImportError):
     USE_REDIS = False
     # Fallback to in-memory storage for single worker
     streams_lock = threading.Lock()
+    streams_cond = threading.Condition(streams_lock)
     streams = {}
 
 # Remove the in-memory streams dictionary and lock
 # streams_lock = threading.Lock()  # Not needed anymore
 # streams = {}  # Not needed anymore
 
+DB_PATH = 'stats.db'
+
+def add_missing_columns(cursor, table, columns):
+    existing = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+    for name, definition in columns:
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
 def init_db():
-    conn = sqlite3.connect('stats.db')
+    conn = sqlite3.connect(DB_PATH)
+    # WAL lets /stats read while the results writer commits
+    conn.execute("PRAGMA journal_mode=WAL")
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS test_results (
@@ -46,44 +222,551 @@ def init_db():
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS submissions (
+            id TEXT PRIMARY KEY,
+            script_hash TEXT,
+            started_at DATETIME,
+            finished_at DATETIME,
+            wall_time REAL,
+            peak_memory INTEGER,
+            passed INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            timeouts INTEGER NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    add_missing_columns(cursor, "submissions", [
+        ("oom_kills", "INTEGER NOT NULL DEFAULT 0"),
+        # 1 when the upload was answered from the result cache instead of being run
+        ("cached", "INTEGER NOT NULL DEFAULT 0"),
+    ])
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_submissions_script_hash ON submissions (script_hash)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_submissions_started_at ON submissions (started_at)")
+
+    # Databases created before submissions existed get the link column added in place
+    add_missing_columns(cursor, "test_results", [
+        ("submission_id", "TEXT REFERENCES submissions (id)"),
+        ("user_time", "REAL"),
+        ("sys_time", "REAL"),
+        ("max_rss", "INTEGER"),
+    ])
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_test_results_submission ON test_results (submission_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_test_results_test_status ON test_results (test_name, status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_test_results_timestamp ON test_results (timestamp)")
+
+    # Running totals kept up to date by the results writer, so /stats never scans test_results
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS test_rollups (
+            test_name TEXT NOT NULL,
+            status TEXT NOT NULL,
+            runs INTEGER NOT NULL DEFAULT 0,
+            total_time REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (test_name, status)
+        )
+    ''')
+    # Runs recorded with CPU time and peak memory; older rows only have wall time
+    add_missing_columns(cursor, "test_rollups", [
+        ("measured_runs", "INTEGER NOT NULL DEFAULT 0"),
+        ("total_cpu_time", "REAL NOT NULL DEFAULT 0"),
+        ("total_max_rss", "INTEGER NOT NULL DEFAULT 0"),
+    ])
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_totals (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    conn.commit()
+
+    # Build the rollups once from the history recorded before they existed. Older databases
+    # mark that with the 'submissions' row, a count guessed from distinct timestamps.
+    cursor.execute("BEGIN IMMEDIATE")
+    if cursor.execute("SELECT 1 FROM stats_totals WHERE name IN ('rollups_built', 'submissions')").fetchone() is None:
+        cursor.execute('''
+            INSERT OR REPLACE INTO test_rollups (test_name, status, runs, total_time)
+            SELECT test_name, status, COUNT(*), COALESCE(SUM(execution_time), 0)
+            FROM test_results GROUP BY test_name, status
+        ''')
+    cursor.execute("INSERT OR IGNORE INTO stats_totals (name, value) VALUES ('rollups_built', 1)")
+    cursor.execute("DELETE FROM stats_totals WHERE name = 'submissions'")
+    # Running count of the submissions table, kept by ResultsWriter so /stats needs no scan;
+    # counted once here for databases that predate it
+    if cursor.execute("SELECT 1 FROM stats_totals WHERE name = 'submission_count'").fetchone() is None:
+        cursor.execute("INSERT INTO stats_totals (name, value) SELECT 'submission_count', COUNT(*) FROM submissions")
     conn.commit()
     conn.close()
 
 init_db()
 
+class BackgroundThreads:
+    """Daemon threads running target, started on first use in each process.
+
+    Threads do not survive fork, so threads started at import would be missing from
+    workers forked from a preloaded app (gunicorn --preload). Every process that
+    uses the owner starts its own instead."""
+
+    def __init__(self, target, name, count=1):
+        self.target = target
+        self.name = name
+        self.count = count
+        self.lock = threading.Lock()
+        self.pid = None  # process the threads were started in
+
+    def ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                for i in range(self.count):
+                    name = self.name if self.count == 1 else f"{self.name}-{i}"
+                    threading.Thread(target=self.target, name=name, daemon=True).start()
+                self.pid = os.getpid()
+
+class ResultsWriter:
+    """Single thread that owns the SQLite write connection.
+
+    Graders hand over all rows of a submission at once and never touch the
+    database themselves. Batches that pile up while a commit is running go
+    into the next transaction together, so concurrent graders cost one
+    write lock and one fsync per batch instead of one per test."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.queue = queue.Queue()
+        self.threads = BackgroundThreads(self._run, "results-writer")
+
+    def record(self, submission, rows):
+        """Queue a Submission together with its TestResult rows."""
+        self.threads.ensure_started()
+        self.queue.put((submission, rows))
+
+    def flush(self):
+        """Block until everything queued so far is committed."""
+        self.threads.ensure_started()
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        while True:
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            batches = [item for item in items if not isinstance(item, threading.Event)]
+            try:
+                with conn:
+                    for submission, rows in batches:
+                        self._write(conn, submission, rows)
+            except sqlite3.Error:
+                app.logger.exception("Failed to store %d result batches", len(batches))
+
+            for item in items:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _write(self, conn, submission, rows):
+        conn.execute('''
+            INSERT OR REPLACE INTO submissions
+                (id, script_hash, started_at, finished_at, wall_time, peak_memory, passed, failed, timeouts, errors,
+                 oom_kills, cached)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', submission)
+        conn.executemany('''
+            INSERT INTO test_results (submission_id, test_name, status, execution_time, user_time, sys_time, max_rss)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(submission.id,) + tuple(row) for row in rows])
+
+        rollups = {}
+        for row in rows:
+            runs, total_time, measured, cpu_time, max_rss = rollups.get((row.test_name, row.status), (0, 0.0, 0, 0.0, 0))
+            if row.max_rss is not None:
+                measured += 1
+                cpu_time += row.user_time + row.sys_time
+                max_rss += row.max_rss
+            rollups[(row.test_name, row.status)] = (runs + 1, total_time + row.execution_time, measured, cpu_time, max_rss)
+        conn.executemany('''
+            INSERT INTO test_rollups (test_name, status, runs, total_time, measured_runs, total_cpu_time, total_max_rss)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (test_name, status) DO UPDATE SET
+                runs = runs + excluded.runs,
+                total_time = total_time + excluded.total_time,
+                measured_runs = measured_runs + excluded.measured_runs,
+                total_cpu_time = total_cpu_time + excluded.total_cpu_time,
+                total_max_rss = total_max_rss + excluded.total_max_rss
+        ''', [key + value for key, value in rollups.items()])
+        conn.execute("UPDATE stats_totals SET value = value + 1 WHERE name = 'submission_count'")
+
+results_writer = ResultsWriter(DB_PATH)
+
+TestResult = namedtuple("TestResult", ["test_name", "status", "execution_time",
+                                       "user_time", "sys_time", "max_rss"])
+
+Submission = namedtuple("Submission", ["id", "script_hash", "started_at", "finished_at", "wall_time",
+                                       "peak_memory", "passed", "failed", "timeouts", "errors", "oom_kills", "cached"])
+
+# Submission fields a result cache entry keeps, so replayed uploads are recorded too
+CACHED_SUBMISSION_FIELDS = ["peak_memory", "passed", "failed", "timeouts", "errors", "oom_kills"]
+
+def db_timestamp():
+    """Current UTC time in the format SQLite's CURRENT_TIMESTAMP uses."""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+STREAM_DONE = "=== Testes Concluídos ==="
+
+# Called with the file_id after every in-memory append; lets the ASGI server wake its coroutines
+stream_observers = []
+
 def append_stream(file_id, msg):
-    """Append message to Redis list for the given file_id"""
+    """Append message to the stream of the given file_id and wake up its readers"""
+    append_stream_batch(file_id, [msg])
+
+def append_stream_batch(file_id, msgs):
+    """Append several messages in one round trip"""
+    append_streams([(file_id, msgs)])
+
+def append_streams(batches):
+    """Append (file_id, messages) batches to several streams in one round trip"""
+    batches = [(file_id, msgs) for file_id, msgs in batches if msgs]
+    if not batches:
+        return
     if USE_REDIS:
-        key = f"stream:{file_id}"
-        redis_client.lpush(key, msg)
-        # Set expiration to clean up old data (24 hours)
-        redis_client.expire(key, 86400)
+        pipe = redis_client.pipeline(transaction=False)
+        for file_id, msgs in batches:
+            # Messages are kept oldest first, so readers can fetch just the tail they miss
+            key = f"stream:{file_id}:log"
+            pipe.rpush(key, *msgs)
+            # Set expiration to clean up old data (24 hours)
+            pipe.expire(key, 86400)
+            pipe.publish(f"stream:{file_id}:new", b"")
+        pipe.execute()
     else:
         # Fallback to in-memory storage
-        with streams_lock:
-            if file_id not in streams:
-                streams[file_id] = []
-            streams[file_id].append(msg)
+        with streams_cond:
+            for file_id, msgs in batches:
+                if file_id not in streams:
+                    streams[file_id] = []
+                streams[file_id].extend(msgs)
+            streams_cond.notify_all()
+        for file_id, _ in batches:
+            for observer in stream_observers:
+                observer(file_id)
 
 def get_stream_messages(file_id, start_index=0):
-    """Get messages from Redis list starting from start_index"""
+    """Get messages from start_index onwards; only the new ones are transferred"""
     if USE_REDIS:
-        key = f"stream:{file_id}"
-        # Get all messages and reverse to maintain chronological order
-        messages = redis_client.lrange(key, 0, -1)
-        messages.reverse()  # Redis LPUSH adds to front, so reverse for chronological order
-        
-        # Convert bytes to strings
-        messages = [msg.decode('utf-8') for msg in messages]
-        
-        # Return messages from start_index onwards
-        return messages[start_index:]
+        messages = redis_client.lrange(f"stream:{file_id}:log", start_index, -1)
+        return [msg.decode('utf-8') for msg in messages]
     else:
         # Fallback to in-memory storage
         with streams_lock:
             messages = streams.get(file_id, [])
             return messages[start_index:]
 
+class StreamListener:
+    """Blocks until a stream may have grown, instead of polling it.
+
+    With Redis this is a pub/sub subscription made before the first read, so
+    no notification is lost between reading and waiting; in memory it is the
+    condition variable append_stream notifies."""
+
+    def __init__(self, file_id):
+        self.file_id = file_id
+        self.pubsub = None
+        if USE_REDIS:
+            self.pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            self.pubsub.subscribe(f"stream:{file_id}:new")
+
+    def wait(self, last_index, timeout):
+        """Wait up to timeout seconds for messages past last_index; False if nothing arrived."""
+        if self.pubsub is not None:
+            # get_message() also returns early (with None) for the subscribe confirmation
+            deadline = time.monotonic() + timeout
+            while self.pubsub.get_message(timeout=max(deadline - time.monotonic(), 0)) is None:
+                if time.monotonic() >= deadline:
+                    return False
+            # One read picks up every message appended so far, so drop the queued notifications
+            while self.pubsub.get_message(timeout=0) is not None:
+                pass
+            return True
+        with streams_cond:
+            return streams_cond.wait_for(lambda: len(streams.get(self.file_id, ())) > last_index, timeout)
+
+    def close(self):
+        if self.pubsub is not None:
+            self.pubsub.close()
+
+DEPENDENCIES = ["search.py", "utils.py"]
+
+TestCase = namedtuple("TestCase", ["name", "output_path", "test_input", "expected_output",
+                                   "expected_keys", "timeout", "difficulty"])
+
+def grid_size(test_input):
+    """Number of cells in a test's input grid, used as its difficulty."""
+    rows = [line for line in test_input.splitlines() if line.strip()]
+    return len(rows) * max((len(row.split()) for row in rows), default=0)
+
+class TestCorpus:
+    """Test inputs, expected outputs and timeouts held in memory.
+
+    Every load() re-stats the test directory, which is cheap, and the files are
+    only read again when a name, mtime or size changed. Expected outputs are
+    normalised for outputs_match() once, when they are read."""
+
+    def __init__(self, tests_dir="tests", default_timeout=2000):
+        self.tests_dir = tests_dir
+        self.default_timeout = default_timeout
+        self.lock = threading.Lock()
+        self.signature = None
+        self.test_cases = []
+        self.fingerprint = None
+
+    def _scan(self):
+        signature = []
+        with os.scandir(self.tests_dir) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    st = entry.stat()
+                    signature.append((entry.name, st.st_mtime_ns, st.st_size))
+        return tuple(sorted(signature))
+
+    def load(self):
+        """Return (test_cases, fingerprint), re-reading the directory first if it changed."""
+        signature = self._scan()
+        with self.lock:
+            if signature != self.signature:
+                self._reload(signature)
+            return self.test_cases, self.fingerprint
+
+    def _read_text(self, name):
+        with open(os.path.join(self.tests_dir, name), "r") as f:
+            return f.read()
+
+    def _reload(self, signature):
+        fingerprint = hashlib.sha256()
+        for name, _, _ in signature:
+            with open(os.path.join(self.tests_dir, name), "rb") as f:
+                fingerprint.update(f"{name}:{hashlib.sha256(f.read()).hexdigest()}\n".encode())
+
+        try:
+            timeout_map = json.loads(self._read_text("timeouts.json"))
+        except Exception as e:
+            raise ValueError(f"Erro ao carregar timeouts.json: {e}")
+
+        names = {name for name, _, _ in signature}
+        test_cases = []
+        for name in sorted(names):
+            if not (name.startswith("test") and name.endswith(".txt")):
+                continue
+            test_name = name[:-len(".txt")]
+            output_name = test_name + ".out"
+            expected_output = self._read_text(output_name) if output_name in names else None
+            test_input = self._read_text(name)
+            test_cases.append(TestCase(
+                name=test_name,
+                output_path=os.path.join(self.tests_dir, output_name),
+                test_input=test_input,
+                expected_output=expected_output,
+                expected_keys=normalize_output(expected_output) if expected_output is not None else None,
+                timeout=timeout_map.get(test_name, self.default_timeout),
+                difficulty=grid_size(test_input),
+            ))
+
+        self.test_cases = test_cases
+        self.fingerprint = fingerprint.hexdigest()
+        self.signature = signature
+
+test_corpus = TestCorpus("tests")
+try:
+    # Load at import so workers forked from a preloaded app share the pages
+    test_corpus.load()
+except Exception:
+    pass  # reported to the first submission that needs the corpus
+
+# Adaptive timeouts: ADAPTIVE_TIMEOUT_FACTOR times the p95 of a test's recent passing runtimes,
+# never below ADAPTIVE_TIMEOUT_FLOOR nor above its timeouts.json value. Tests with fewer than
+# ADAPTIVE_TIMEOUT_MIN_SAMPLES passing runs keep the static timeout. Set the factor to 0 to disable.
+ADAPTIVE_TIMEOUT_FACTOR = float(os.environ.get("ADAPTIVE_TIMEOUT_FACTOR", 3))
+ADAPTIVE_TIMEOUT_FLOOR = float(os.environ.get("ADAPTIVE_TIMEOUT_FLOOR", 2))
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = int(os.environ.get("ADAPTIVE_TIMEOUT_MIN_SAMPLES", 20))
+ADAPTIVE_TIMEOUT_WINDOW = int(os.environ.get("ADAPTIVE_TIMEOUT_WINDOW", 500))  # newest runs used per test
+# "history" runs quick, often failing tests first once every test has TEST_ORDER_MIN_RUNS stored
+# runs, and smallest grid first until then; "name" keeps the plain name order
+TEST_ORDER = os.environ.get("TEST_ORDER", "history")
+TEST_ORDER_MIN_RUNS = int(os.environ.get("TEST_ORDER_MIN_RUNS", 5))
+TEST_HISTORY_REFRESH = float(os.environ.get("TEST_HISTORY_REFRESH", 300))
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+class TestHistory:
+    """Per-test timeouts and run order learned from stats.db, recomputed by a background thread.
+
+    Graders only read the dicts computed by the last refresh, so looking a test
+    up never touches the database."""
+
+    def __init__(self, db_path, factor, floor, min_samples, window, min_runs, refresh_interval):
+        self.db_path = db_path
+        self.factor = factor
+        self.floor = floor
+        self.min_samples = min_samples
+        self.window = window
+        self.min_runs = min_runs
+        self.refresh_interval = refresh_interval
+        self.learned = {}  # test_name -> seconds, before clamping to the static timeout
+        self.medians = {}  # test_name -> median passing runtime
+        self.failure_rates = {}  # test_name -> share of stored runs that did not pass
+        self.threads = BackgroundThreads(self._run, "test-history")
+
+    def timeout_for(self, case):
+        self.threads.ensure_started()
+        learned = self.learned.get(case.name) if self.factor > 0 else None
+        if learned is None:
+            return case.timeout
+        return min(case.timeout, learned)
+
+    def _cost(self, case):
+        # Expected seconds spent per failure found; tests that never passed are charged their timeout
+        failure_rate = self.failure_rates.get(case.name)
+        if failure_rate is None:
+            return None
+        return self.medians.get(case.name, case.timeout) / (failure_rate + 0.05)
+
+    def order(self, cases):
+        """Cases in the order they should run."""
+        self.threads.ensure_started()
+        costs = [self._cost(case) for case in cases]
+        if None in costs:
+            return sorted(cases, key=lambda case: (case.difficulty, case.name))
+        return [case for _, case in sorted(zip(costs, cases), key=lambda item: (item[0], item[1].name))]
+
+    def refresh(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            totals = conn.execute('''
+                SELECT test_name, SUM(runs), SUM(CASE WHEN status = 'PASSED' THEN runs ELSE 0 END)
+                FROM test_rollups GROUP BY test_name
+            ''').fetchall()
+            samples = {}
+            for test_name, _, passed in totals:
+                if passed:
+                    # Walks idx_test_results_test_status backwards, newest runs first
+                    samples[test_name] = [row[0] for row in conn.execute(
+                        "SELECT execution_time FROM test_results WHERE test_name = ? AND status = 'PASSED' "
+                        "ORDER BY id DESC LIMIT ?", (test_name, self.window))]
+        finally:
+            conn.close()
+
+        learned = {}
+        for test_name, times in samples.items():
+            if len(times) >= self.min_samples:
+                # Rounded up to a tenth of a second so the streamed timeout stays readable
+                timeout = max(self.floor, self.factor * percentile(times, 0.95))
+                learned[test_name] = math.ceil(timeout * 10) / 10
+        self.learned = learned
+        self.medians = {test_name: percentile(times, 0.5) for test_name, times in samples.items() if times}
+        self.failure_rates = {test_name: (runs - passed) / runs
+                              for test_name, runs, passed in totals if runs >= self.min_runs}
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except sqlite3.Error:
+                app.logger.exception("Failed to refresh the test history")
+            time.sleep(self.refresh_interval)
+
+test_history = TestHistory(DB_PATH, ADAPTIVE_TIMEOUT_FACTOR, ADAPTIVE_TIMEOUT_FLOOR, ADAPTIVE_TIMEOUT_MIN_SAMPLES,
+                           ADAPTIVE_TIMEOUT_WINDOW, TEST_ORDER_MIN_RUNS, TEST_HISTORY_REFRESH)
+
+# Digests of the dependency files, reused while their mtime and size are unchanged
+_file_digests = {}
+
+def corpus_fingerprint():
+    """Hash of the test corpus, timeouts.json and the dependencies copied into each sandbox."""
+    _, tests_fingerprint = test_corpus.load()
+    fingerprint = hashlib.sha256(tests_fingerprint.encode())
+    for path in [os.path.join("dependencies", dep) for dep in DEPENDENCIES]:
+        st = os.stat(path)
+        cached = _file_digests.get(path)
+        if cached is None or cached[0] != (st.st_mtime_ns, st.st_size):
+            with open(path, "rb") as f:
+                cached = ((st.st_mtime_ns, st.st_size), hashlib.sha256(f.read()).hexdigest())
+            _file_digests[path] = cached
+        fingerprint.update(f"{path}:{cached[1]}\n".encode())
+    return fingerprint.hexdigest()
+
+class ResultCache:
+    """Results of finished runs, keyed by script hash and corpus fingerprint.
+
+    A result is a dict with the run's stream "messages" and the counts of its
+    "submission" row (CACHED_SUBMISSION_FIELDS). Entries in any other shape,
+    left by older versions, read as misses.
+
+    Entries expire after max_age seconds and only the newest max_entries are
+    kept. A change to the tests or dependencies changes the fingerprint, so
+    stale entries are never hit and simply age out."""
+
+    def __init__(self, max_entries, max_age):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (stored_at, result), oldest first
+
+    @staticmethod
+    def key(script_hash, fingerprint):
+        return f"{script_hash}:{fingerprint}"
+
+    def get(self, script_hash, fingerprint):
+        key = self.key(script_hash, fingerprint)
+        if USE_REDIS:
+            data = redis_client.get(f"result:{key}")
+            result = json.loads(data) if data is not None else None
+        else:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is None:
+                    return None
+                if time.time() - entry[0] > self.max_age:
+                    del self.entries[key]
+                    return None
+                result = entry[1]
+        return result if isinstance(result, dict) and "submission" in result else None
+
+    def put(self, script_hash, fingerprint, result):
+        key = self.key(script_hash, fingerprint)
+        if USE_REDIS:
+            now = time.time()
+            pipe = redis_client.pipeline()
+            pipe.set(f"result:{key}", json.dumps(result), ex=self.max_age)
+            pipe.zadd("result_index", {key: now})
+            pipe.zremrangebyscore("result_index", 0, now - self.max_age)
+            pipe.zcard("result_index")
+            size = pipe.execute()[-1]
+            if size > self.max_entries:
+                evicted = redis_client.zpopmin("result_index", size - self.max_entries)
+                if evicted:
+                    redis_client.delete(*[f"result:{k.decode()}" for k, _ in evicted])
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), result)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", 1000))
+RESULT_CACHE_MAX_AGE = int(os.environ.get("RESULT_CACHE_MAX_AGE", 7 * 86400))
+result_cache = ResultCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_AGE)
+
 app.config['MAX_CONTENT_LENGTH'] = 102400  # bytes
 
 DANGEROUS_MODULES = {"os", "subprocess", "shutil", "socket", "requests"}
@@ -115,30 +798,50 @@ def is_script_safe(code):
 def index():
     return render_template('index.html')
 
+def make_sandbox(file_id, script):
+    """Directory the submission runs in, holding script.py and the dependencies; returns (dir, script path)."""
+    sandbox_dir = os.path.join("temp_runs", file_id)
+    os.makedirs(sandbox_dir, exist_ok=True)
+
+    script_path = os.path.join(sandbox_dir, "script.py")
+    with open(script_path, "wb") as f:
+        f.write(script)
+
+    for dep in DEPENDENCIES:
+        shutil.copy(os.path.join("dependencies", dep), sandbox_dir)
+    return sandbox_dir, script_path
+
 @app.route('/upload', methods=['POST'])
 def upload():
     file = request.files['file']
 
-    content = file.read().decode('utf-8', errors='ignore')
+    raw = file.read()
+    content = raw.decode('utf-8', errors='ignore')
     if not is_script_safe(content):
         return "❌ O ficheiro contém código potencialmente perigoso.", 400
 
-    file.seek(0)
-
     file_id = str(uuid.uuid4())
-    sandbox_dir = os.path.join("temp_runs", file_id)
-    os.makedirs(sandbox_dir, exist_ok=True)
 
-    script_path = os.path.join(sandbox_dir, "script.py")
-    file.save(script_path)
+    script_hash = hashlib.sha256(raw).hexdigest()
+    try:
+        cached = result_cache.get(script_hash, corpus_fingerprint())
+    except Exception:
+        cached = None
+    if cached is not None:
+        append_stream_batch(file_id, ["♻️ Submissão idêntica já avaliada, a mostrar o resultado guardado."]
+                            + cached["messages"] + [STREAM_DONE])
+        # Counted as a submission, but its tests were not run so no test_results rows are added
+        now = db_timestamp()
+        results_writer.record(Submission(id=file_id, script_hash=script_hash, started_at=now, finished_at=now,
+                                         wall_time=0, cached=1, **cached["submission"]), [])
+        return redirect(url_for('results', file_id=file_id))
 
-    for dep in ["search.py", "utils.py"]:
-        shutil.copy(os.path.join("dependencies", dep), sandbox_dir)
+    sandbox_dir, script_path = make_sandbox(file_id, raw)
 
-    # Initialize the stream in Redis
-    append_stream(file_id, "Iniciando testes...")
-    
-    threading.Thread(target=run_tests, args=(file_id, script_path, sandbox_dir), daemon=True).start()
+    submitter = request.remote_addr
+    if not submission_scheduler.submit(submitter, file_id, script_path, sandbox_dir, script_hash):
+        shutil.rmtree(sandbox_dir, ignore_errors=True)
+        return "❌ A fila de avaliação está cheia. Tenta novamente dentro de alguns minutos.", 503
 
     return redirect(url_for('results', file_id=file_id))
 
@@ -146,31 +849,44 @@ def upload():
 def results(file_id):
     return render_template('results.html', file_id=file_id)
 
+STREAM_KEEPALIVE = 15  # seconds between comments on an idle connection
+
 @app.route('/stream/<file_id>')
 def stream(file_id):
-    def event_stream():
+    # Event ids are message counts, so a reconnecting browser resumes after the last one it saw
+    try:
+        last_index = max(int(request.headers.get('Last-Event-ID', 0)), 0)
+    except ValueError:
         last_index = 0
-        while True:
-            try:
-                # Get new messages from Redis
+
+    def event_stream(last_index):
+        listener = StreamListener(file_id)
+        try:
+            if last_index and get_stream_messages(file_id, last_index - 1)[:1] == [STREAM_DONE]:
+                yield "event: end\ndata: \n\n"
+                return
+            while True:
                 updates = get_stream_messages(file_id, last_index)
                 for update in updates:
-                    yield f"data: {update}\n\n"
-                last_index += len(updates)
-                
+                    last_index += 1
+                    yield f"id: {last_index}\ndata: {update}\n\n"
+
                 # Check if tests are completed
-                if updates and "=== Testes Concluídos ===" in updates:
+                if STREAM_DONE in updates:
+                    yield "event: end\ndata: \n\n"
                     break
-                    
-                time.sleep(1)  # Use time.sleep instead of gevent.sleep
-            except Exception as e:
-                yield f"data: Erro na stream: {str(e)}\n\n"
-                break
-    
-    return Response(event_stream(), content_type='text/event-stream')
+
+                if not updates and not listener.wait(last_index, STREAM_KEEPALIVE):
+                    yield ": keepalive\n\n"
+        except Exception as e:
+            yield f"data: Erro na stream: {str(e)}\n\n"
+        finally:
+            listener.close()
+
+    return Response(event_stream(last_index), content_type='text/event-stream')
 
 def limit_memory():
-    mem_bytes = 10 * 1024 * 1024 * 1024  # 10 GB limit for user scripts
+    mem_bytes = MEMORY_LIMIT
     resource.setrlimit(resource.RLIMIT_AS, (mem_bytes, mem_bytes))
     # Also limit RSS (physical memory) if available
     try:
@@ -178,108 +894,454 @@ def limit_memory():
     except (AttributeError, OSError):
         pass  # RLIMIT_RSS not available on all systems
 
-def run_tests(file_id, script_path, sandbox_dir):
-    try:
-        with open("tests/timeouts.json", "r") as f:
-            timeout_map = json.load(f)
-    except Exception as e:
-        append_stream(file_id, f"⚠️ Erro ao carregar timeouts.json: {e}")
-        return
+# Whitespace ignored inside lines, as with `diff -w --strip-trailing-cr`
+_WHITESPACE = str.maketrans("", "", " \t\r\v\f")
+MAX_DIFF_LINES = 200
 
-    test_files = sorted(glob.glob("tests/test*.txt"))
-    if not test_files:
-        append_stream(file_id, "⚠️ Nenhum teste encontrado na pasta 'tests'.")
-        return
+def split_output(text):
+    """Split text into lines like diff does; returns (lines, missing_final_newline)."""
+    if not text:
+        return [], False
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+        return lines, False
+    return lines, True
 
-    for input_path in test_files:
-        test_name = os.path.basename(input_path).replace(".txt", "")
-        output_path = input_path.replace(".txt", ".out")
+def normalize_output(text):
+    """Lines of text reduced to what `diff -w` compares."""
+    return [line.translate(_WHITESPACE) for line in split_output(text)[0]]
 
-        if not os.path.exists(output_path):
-            append_stream(file_id, f"[{test_name}] ❌ Output esperado não encontrado: {output_path}")
+def outputs_match(actual, expected_keys):
+    """Pass/fail comparison against normalize_output(expected) that stops at the first differing line."""
+    actual_lines, _ = split_output(actual)
+    if len(actual_lines) != len(expected_keys):
+        return False
+    for line, key in zip(actual_lines, expected_keys):
+        if line != key and line.translate(_WHITESPACE) != key:
+            return False
+    return True
+
+def diff_outputs(actual, expected, max_lines=MAX_DIFF_LINES):
+    """Normal-format diff of actual against expected, as `diff -w` would print it, capped at max_lines."""
+    a_lines, a_no_eol = split_output(actual)
+    b_lines, b_no_eol = split_output(expected)
+    matcher = difflib.SequenceMatcher(None,
+                                      [line.translate(_WHITESPACE) for line in a_lines],
+                                      [line.translate(_WHITESPACE) for line in b_lines],
+                                      autojunk=False)
+
+    def span(lo, hi):
+        return str(lo + 1) if hi - lo == 1 else f"{lo + 1},{hi}"
+
+    def side(prefix, lines, lo, hi, no_eol):
+        out = [f"{prefix} {line}" for line in lines[lo:hi]]
+        if no_eol and hi == len(lines):
+            out.append("\\ No newline at end of file")
+        return out
+
+    diff = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
             continue
+        if tag == 'replace':
+            diff.append(f"{span(i1, i2)}c{span(j1, j2)}")
+            diff += side("<", a_lines, i1, i2, a_no_eol)
+            diff.append("---")
+            diff += side(">", b_lines, j1, j2, b_no_eol)
+        elif tag == 'delete':
+            diff.append(f"{span(i1, i2)}d{j1}")
+            diff += side("<", a_lines, i1, i2, a_no_eol)
+        else:
+            diff.append(f"{i1}a{span(j1, j2)}")
+            diff += side(">", b_lines, j1, j2, b_no_eol)
+        if len(diff) > max_lines:
+            return diff[:max_lines] + ["... (diferença truncada)"]
+    return diff
 
-        timeout = timeout_map.get(test_name, 2000)
-        append_stream(file_id, f"[{test_name}] Em execução com timeout={timeout}s...")
+class ColdChild:
+    """Submission started as a fresh `python3 script.py`, with the same interface as a WarmChild."""
 
+    def __init__(self, script, cwd, cgroup=None, cpu_limit=None, core=None):
+        stdin_r, self.stdin = os.pipe()
+        self.stdout, stdout_w = os.pipe()
         try:
-            with open(input_path, "r") as f:
-                test_input = f.read()
-            with open(output_path, "r") as f:
-                expected_output = f.read()
-
-            start_time = time.perf_counter()
-            proc = subprocess.run(
-                ["python3", os.path.basename(script_path)],
-                cwd=sandbox_dir,
-                input=test_input,
-                stdout=subprocess.PIPE,
+            self.proc = subprocess.Popen(
+                ["python3", script],
+                cwd=cwd,
+                stdin=stdin_r,
+                stdout=stdout_w,
                 stderr=subprocess.STDOUT,
-                timeout=timeout,
-                text=True,
                 shell=False,
-                preexec_fn=limit_memory
+                start_new_session=True,
+                preexec_fn=lambda: prepare_child(cgroup, cpu_limit, core)
             )
-            elapsed = time.perf_counter() - start_time
+        except Exception:
+            os.close(self.stdin)
+            os.close(self.stdout)
+            raise
+        finally:
+            os.close(stdin_r)
+            os.close(stdout_w)
+        self.pid = self.proc.pid
+
+    def wait(self, deadline=None):
+        """Reap the child with wait4 so its CPU time and peak memory come back too."""
+        delay = 0.0005
+        while True:
+            pid, status, rusage = os.wait4(self.pid, 0 if deadline is None else os.WNOHANG)
+            if pid:
+                self.proc.returncode = os.waitstatus_to_exitcode(status)
+                return status, usage_from_rusage(rusage)
+            if time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(self.proc.args, None)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
 
-            real_out_file = os.path.join(sandbox_dir, f"real_out.txt")
-            exp_out_file = os.path.join(sandbox_dir, f"exp_out.txt")
+    def kill(self):
+        kill_group(self.pid)
 
-            with open(real_out_file, "w") as f:
-                f.write(proc.stdout)
-            with open(exp_out_file, "w") as f:
-                f.write(expected_output)
+    def close(self):
+        os.close(self.stdout)
 
-            diff_result = subprocess.run(
-                ["/usr/bin/diff", "-w", "--strip-trailing-cr", real_out_file, exp_out_file],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
+def prepare_child(cgroup, cpu_limit, core):
+    """Runs in the forked child before exec; the same limits warm_pool.run_child applies."""
+    if cgroup is not None:
+        with open(os.path.join(cgroup, "cgroup.procs"), "w") as f:
+            f.write("0")
+    else:
+        limit_memory()
+    if cpu_limit is not None:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 1))
+    if core is not None:
+        os.sched_setaffinity(0, {core})
 
-            conn = sqlite3.connect('stats.db')
-            cursor = conn.cursor()
-
-            if diff_result.returncode == 0:
-                append_stream(file_id, f"[{test_name}] ✅ PASSOU em {elapsed:.5f}s")
-                cursor.execute("INSERT INTO test_results (test_name, status, execution_time) VALUES (?, ?, ?)",
-                             (test_name, 'PASSED', elapsed))
-            else:
-                append_stream(file_id, f"[{test_name}] ❌ FALHOU")
-                append_stream(file_id, "Diferença:")
-                for line in diff_result.stdout.splitlines():
-                    append_stream(file_id, line)
-                cursor.execute("INSERT INTO test_results (test_name, status, execution_time) VALUES (?, ?, ?)",
-                             (test_name, 'FAILED', elapsed))
-
-            conn.commit()
-            conn.close()
+# Output allowed beyond the expected one before the child is stopped
+OUTPUT_LIMIT_FACTOR = float(os.environ.get("OUTPUT_LIMIT_FACTOR", 2))
+OUTPUT_LIMIT_MARGIN = int(os.environ.get("OUTPUT_LIMIT_MARGIN", 64 * 1024))
 
-            os.remove(real_out_file)
-            os.remove(exp_out_file)
+class OutputMonitor:
+    """Compares a test's output with the expected lines while the child is still writing it.
 
-        except subprocess.TimeoutExpired:
-            append_stream(file_id, f"[{test_name}] ⏱️ Timeout após {timeout}s")
+    Each complete line is checked with the same rule as outputs_match(), so a line that
+    differs, or one line too many, already decides the test. At most limit bytes are
+    kept; more output than that stops the run as well."""
 
-            conn = sqlite3.connect('stats.db')
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO test_results (test_name, status, execution_time) VALUES (?, ?, ?)",
-                         (test_name, 'TIMEOUT', timeout))
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            append_stream(file_id, f"[{test_name}] 💥 Erro: {e}")
+    def __init__(self, expected_keys, limit):
+        self.expected_keys = expected_keys
+        self.limit = limit
+        self.chunks = []
+        self.size = 0
+        self.partial = b""  # last line, still without its newline (or a \r that may start a \r\n)
+        self.line_no = 0
+        self.verdict = None  # 'overflow' or 'diverged' once the output can no longer pass
 
-            conn = sqlite3.connect('stats.db')
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO test_results (test_name, status, execution_time) VALUES (?, ?, ?)",
-                         (test_name, 'ERROR', 0))
-            conn.commit()
-            conn.close()
+    def feed(self, chunk):
+        """Take the next chunk of output; returns True when the run can be stopped."""
+        if self.size + len(chunk) > self.limit:
+            chunk = chunk[:self.limit - self.size]
+            self.verdict = 'overflow'
+        self.chunks.append(chunk)
+        self.size += len(chunk)
 
-        time.sleep(0.5)
+        # Line ends are folded like the final stdout: \r\n and a lone \r both end a line
+        data = self.partial + chunk
+        held = b"\r" if data.endswith(b"\r") else b""
+        if held:
+            data = data[:-1]
+        *lines, partial = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n").split(b"\n")
+        self.partial = partial + held
+        for raw in lines:
+            if self.line_no >= len(self.expected_keys):
+                self.verdict = 'diverged'
+                break
+            line = raw.decode(errors="replace")
+            if line.translate(_WHITESPACE) != self.expected_keys[self.line_no]:
+                self.verdict = 'diverged'
+                break
+            self.line_no += 1
+        return self.verdict is not None
+
+    def output(self):
+        return b"".join(self.chunks)
+
+def output_limit(expected_output):
+    return int(len(expected_output.encode()) * OUTPUT_LIMIT_FACTOR) + OUTPUT_LIMIT_MARGIN
+
+class TestAborted(Exception):
+    """The submission's time budget ran out while the test was running."""
+
+RunResult = namedtuple("RunResult", ["returncode", "stdout", "usage", "oom_killed"])
+
+def spawn_script(script, sandbox_dir, cgroup=None, cpu_limit=None, core=None):
+    """Start the submission, forked from the warm pool when it is available."""
+    if warm_pool is not None:
+        try:
+            return warm_pool.spawn(script, sandbox_dir, cgroup, cpu_limit, core)
+        except WarmPoolUnavailable:
+            pass
+    return ColdChild(script, sandbox_dir, cgroup, cpu_limit, core)
 
-    append_stream(file_id, "=== Testes Concluídos ===")
+def execute_script(script_path, sandbox_dir, test_input, timeout, core=None, abort_at=None, monitor=None):
+    """Run the submission on one input; raises subprocess.TimeoutExpired once it uses up its timeout.
+
+    In cpu timing mode the timeout counts CPU seconds, and the exception's timeout attribute
+    tells a CPU budget (== timeout) apart from the wall-clock safety limit (> timeout).
+    The child is also killed at abort_at (a time.monotonic() value), raising TestAborted.
+    With an OutputMonitor the output is checked as it arrives and the child is killed as
+    soon as the monitor reaches a verdict; stdout is then the output read up to that point."""
+    script = os.path.basename(script_path)
+    if TIMING_MODE == "cpu":
+        cpu_limit = math.ceil(timeout)
+        wall_timeout = timeout * CPU_TIMEOUT_WALL_FACTOR
+    else:
+        cpu_limit = None
+        wall_timeout = timeout
+    sandbox = CgroupSandbox(CGROUP_ROOT) if USE_CGROUPS else None
+    try:
+        child = spawn_script(script, sandbox_dir, sandbox and sandbox.path, cpu_limit, core)
+        deadline = time.monotonic() + wall_timeout
+        aborting = abort_at is not None and abort_at < deadline
+        if aborting:
+            deadline = abort_at
+        try:
+            try:
+                output = communicate(child.stdin, child.stdout, test_input.encode(), deadline,
+                                     monitor.feed if monitor is not None else None)
+                if monitor is not None:
+                    output = monitor.output()
+                    if monitor.verdict is not None:
+                        # The test has already failed, so the rest of the output is not needed
+                        child.kill()
+                # Output is closed, but the child may still be running
+                status, usage = child.wait(deadline)
+            except subprocess.TimeoutExpired:
+                child.kill()
+                try:
+                    child.wait()
+                except WarmPoolUnavailable:
+                    # The template reaps the killed child anyway; the run still timed out
+                    pass
+                if aborting:
+                    raise TestAborted()
+                raise subprocess.TimeoutExpired(["python3", script], wall_timeout)
+            except BaseException:
+                child.kill()
+                raise
+        finally:
+            child.close()
+
+        # RLIMIT_CPU only has whole-second resolution, so compare the measured time as well
+        cpu_killed = os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGXCPU
+        if cpu_limit is not None and (cpu_killed or usage.user_time + usage.sys_time >= timeout):
+            raise subprocess.TimeoutExpired(["python3", script], timeout)
+
+        oom_killed = False
+        if sandbox is not None:
+            oom_killed = sandbox.oom_killed()
+            # The cgroup also counts page cache and every process the script started
+            peak = sandbox.peak_memory()
+            if peak is not None:
+                usage = usage._replace(max_rss=peak)
+    finally:
+        if sandbox is not None:
+            sandbox.remove()
+
+    stdout = output.decode(errors="replace").replace("\r\n", "\n").replace("\r", "\n")
+    return RunResult(os.waitstatus_to_exitcode(status), stdout, usage, oom_killed)
+
+def format_bytes(n):
+    return f"{n / (1024 * 1024):.1f} MB"
+
+# Early-abort policies, all disabled when 0: stop once this many tests did not pass, stop once the
+# submission has been running for this many seconds, and skip tests whose grid is at least as
+# large as one that already timed out
+ABORT_AFTER_FAILURES = int(os.environ.get("ABORT_AFTER_FAILURES", 0))
+SUBMISSION_TIME_BUDGET = float(os.environ.get("SUBMISSION_TIME_BUDGET", 0))
+SKIP_HARDER_AFTER_TIMEOUT = os.environ.get("SKIP_HARDER_AFTER_TIMEOUT", "0") == "1"
+
+class AbortPolicy:
+    """Decides, as each test is about to start, whether a submission is already hopeless.
+
+    Shared by the submission's tests on the pool and updated as soon as each one finishes,
+    so tests still queued behind a failure are skipped instead of run. The time budget
+    starts with the first test, so time spent queued behind other submissions is free."""
+
+    def __init__(self, max_failures=0, time_budget=0, skip_harder=False):
+        self.max_failures = max_failures
+        self.skip_harder = skip_harder
+        self.abort_at = None  # time.monotonic() deadline, set when the first test starts
+        self.time_budget = time_budget
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.timed_out = None  # easiest test that timed out so far
+
+    def skip_reason(self, case):
+        """Why case should not run, or None. Called as each test starts."""
+        with self.lock:
+            if self.time_budget and self.abort_at is None:
+                self.abort_at = time.monotonic() + self.time_budget
+            if self.max_failures and self.failures >= self.max_failures:
+                return f"a submissão já falhou {self.failures} testes"
+            if self.abort_at is not None and time.monotonic() >= self.abort_at:
+                return f"orçamento de {self.time_budget:g}s da submissão esgotado"
+            if self.skip_harder and self.timed_out is not None and case.difficulty >= self.timed_out.difficulty:
+                return f"{self.timed_out.name} já excedeu o tempo limite com uma grelha igual ou mais pequena"
+        return None
+
+    def record(self, case, status):
+        with self.lock:
+            if status in ('FAILED', 'TIMEOUT', 'ERROR', 'OOM'):
+                self.failures += 1
+            if status == 'TIMEOUT' and (self.timed_out is None or case.difficulty < self.timed_out.difficulty):
+                self.timed_out = case
+
+def run_single_test(case, script_path, sandbox_dir, policy=None):
+    """Run one test case; returns its status, the stream messages it produced, its wall time, its Usage
+    and whether the verdict depends only on the script, so it may be cached.
+
+    Tests the policy rules out come back as SKIPPED without being run."""
+    test_name = case.name
+    timeout = case.timeout
+    if policy is not None:
+        reason = policy.skip_reason(case)
+        if reason is not None:
+            return 'SKIPPED', [f"[{test_name}] ⏭️ Ignorado: {reason}"], None, None, False
+    unit = " de CPU" if TIMING_MODE == "cpu" else ""
+    messages = [f"[{test_name}] Em execução com timeout={timeout}s{unit}..."]
+
+    # Waiting for a free core is not part of the test's time
+    core = core_pool.acquire() if core_pool is not None else None
+    monitor = OutputMonitor(case.expected_keys, output_limit(case.expected_output))
+    killed = False
+    try:
+        start_time = time.perf_counter()
+        proc = execute_script(script_path, sandbox_dir, case.test_input, timeout, core,
+                              policy.abort_at if policy is not None else None, monitor)
+        elapsed = time.perf_counter() - start_time
+        usage = proc.usage
+        # A child killed by a signal we did not send (SIGKILL from the host's OOM killer,
+        # say) failed because of the machine, not because of its output
+        killed = proc.returncode < 0 and monitor.verdict is None
+
+        if proc.oom_killed:
+            status = 'OOM'
+            messages.append(f"[{test_name}] 💾 Memória esgotada após {elapsed:.5f}s (limite memory.max={CGROUP_MEMORY_MAX})")
+        elif monitor.verdict is None and outputs_match(proc.stdout, case.expected_keys):
+            status = 'PASSED'
+            messages.append(f"[{test_name}] ✅ PASSOU em {elapsed:.5f}s "
+                            f"(CPU {usage.user_time + usage.sys_time:.5f}s, memória {format_bytes(usage.max_rss)})")
+        else:
+            status = 'FAILED'
+            messages.append(f"[{test_name}] ❌ FALHOU")
+            if monitor.verdict == 'overflow':
+                messages.append(f"Saída maior do que {format_bytes(monitor.limit)}; processo terminado.")
+            elif monitor.verdict == 'diverged':
+                messages.append(f"Saída diferente na linha {monitor.line_no + 1}; processo terminado.")
+            messages.append("Diferença:")
+            messages.extend(diff_outputs(proc.stdout, case.expected_output))
+
+    except subprocess.TimeoutExpired as e:
+        status = 'TIMEOUT'
+        elapsed = timeout
+        usage = None
+        if e.timeout > timeout:
+            messages.append(f"[{test_name}] ⏱️ Timeout após {e.timeout:g}s de tempo real")
+        else:
+            messages.append(f"[{test_name}] ⏱️ Timeout após {timeout}s{unit}")
+    except TestAborted:
+        status = 'SKIPPED'
+        elapsed = None
+        usage = None
+        messages.append(f"[{test_name}] ⏭️ Interrompido: orçamento de {policy.time_budget:g}s da submissão esgotado")
+    except Exception as e:
+        status = 'ERROR'
+        elapsed = 0
+        usage = None
+        messages.append(f"[{test_name}] 💥 Erro: {e}")
+    finally:
+        if core is not None:
+            core_pool.release(core)
+
+    if policy is not None:
+        policy.record(case, status)
+    # Grader errors, wall-clock timeouts, OOM kills and skips depend on the grader, not only on the script
+    cacheable = status not in ('ERROR', 'TIMEOUT', 'OOM', 'SKIPPED') and not killed
+    return status, messages, elapsed, usage, cacheable
+
+def make_submission(file_id, script_hash, started_at, wall_time, rows):
+    """Submission row summarising the TestResult rows of one graded script."""
+    statuses = [row.status for row in rows]
+    peaks = [row.max_rss for row in rows if row.max_rss is not None]
+    return Submission(
+        id=file_id,
+        script_hash=script_hash,
+        started_at=started_at,
+        finished_at=db_timestamp(),
+        wall_time=wall_time,
+        peak_memory=max(peaks, default=None),
+        passed=statuses.count('PASSED'),
+        failed=statuses.count('FAILED'),
+        timeouts=statuses.count('TIMEOUT'),
+        errors=statuses.count('ERROR'),
+        oom_kills=statuses.count('OOM'),
+        cached=0,
+    )
+
+def grading_cases(test_cases):
+    """The corpus' test cases in the order and with the timeouts they are graded with right now."""
+    if TEST_ORDER == "history":
+        test_cases = test_history.order(test_cases)
+    return [case._replace(timeout=test_history.timeout_for(case)) for case in test_cases]
+
+def run_tests(file_id, script_path, sandbox_dir, script_hash=None):
+    started_at = db_timestamp()
+    start_time = time.perf_counter()
+    try:
+        test_cases, _ = test_corpus.load()
+        fingerprint = corpus_fingerprint()
+    except Exception as e:
+        append_stream(file_id, f"⚠️ {e}")
+        return
+
+    if not test_cases:
+        append_stream(file_id, "⚠️ Nenhum teste encontrado na pasta 'tests'.")
+        return
+
+    test_cases = grading_cases(test_cases)
+    policy = AbortPolicy(ABORT_AFTER_FAILURES, SUBMISSION_TIME_BUDGET, SKIP_HARDER_AFTER_TIMEOUT)
+
+    # Tests run concurrently on the shared pool; results are streamed back in test order
+    pending = []
+    for case in test_cases:
+        if case.expected_output is None:
+            pending.append((case, ('MISSING', [f"[{case.name}] ❌ Output esperado não encontrado: {case.output_path}"], None, None, True)))
+            continue
+
+        pending.append((case, test_executor.submit(run_single_test, case, script_path, sandbox_dir, policy)))
+
+    emitted = []
+    rows = []
+    cacheable = True
+    for case, entry in pending:
+        status, messages, elapsed, usage, test_cacheable = entry.result() if isinstance(entry, Future) else entry
+        append_stream_batch(file_id, messages)
+        emitted.extend(messages)
+        # Skipped tests say nothing about the test itself, so they are not stored
+        if status not in ('MISSING', 'SKIPPED'):
+            rows.append(TestResult(case.name, status, elapsed, *(usage or (None, None, None))))
+        cacheable = cacheable and test_cacheable
+
+    append_stream(file_id, STREAM_DONE)
+
+    submission = make_submission(file_id, script_hash, started_at, time.perf_counter() - start_time, rows)
+    results_writer.record(submission, rows)
+
+    if script_hash is not None and cacheable and corpus_fingerprint() == fingerprint:
+        result_cache.put(script_hash, fingerprint, {
+            "messages": emitted,
+            "submission": {field: getattr(submission, field) for field in CACHED_SUBMISSION_FIELDS},
+        })
 
     # Cleanup
     if os.path.exists(script_path):
@@ -287,19 +1349,126 @@ def run_tests(file_id, script_path, sandbox_dir):
     if os.path.exists(sandbox_dir):
         shutil.rmtree(sandbox_dir)
 
+class SubmissionScheduler:
+    """Bounded admission queue feeding a fixed number of grader threads.
+
+    Jobs are kept in one queue per submitter and served round-robin, so a
+    student uploading many files cannot starve everybody else. Waiting jobs
+    are told their position through their own stream; positions are worked
+    out under the lock but streamed after releasing it, so a slow stream
+    backend never holds up uploads or graders."""
+
+    def __init__(self, workers, max_queued, max_per_submitter):
+        self.max_queued = max_queued
+        self.max_per_submitter = max_per_submitter
+        self.cond = threading.Condition()
+        self.queues = OrderedDict()  # submitter -> deque of jobs, in serving order
+        self.queued = 0
+        self.positions = {}  # file_id -> current position, kept under self.cond
+        self.announce_lock = threading.Lock()  # serialises publishing, so positions arrive in order
+        self.published = {}  # file_id -> last position streamed, kept under self.announce_lock
+        self.threads = BackgroundThreads(self._worker, "grader", workers)
+
+    def submit(self, submitter, file_id, script_path, sandbox_dir, script_hash=None):
+        """Queue a submission; returns False when it has to be rejected."""
+        self.threads.ensure_started()
+        with self.cond:
+            queue = self.queues.get(submitter)
+            if self.queued >= self.max_queued:
+                return False
+            if queue is not None and len(queue) >= self.max_per_submitter:
+                return False
+            if queue is None:
+                queue = self.queues[submitter] = deque()
+            queue.append((file_id, script_path, sandbox_dir, script_hash))
+            self.queued += 1
+            self._update_positions()
+            self.cond.notify()
+        self._publish_positions()
+        return True
+
+    def _serving_order(self):
+        # Round-robin over submitters: everybody's first job, then everybody's second, ...
+        queues = list(self.queues.values())
+        order = []
+        for depth in range(max((len(q) for q in queues), default=0)):
+            order.extend(q[depth] for q in queues if depth < len(q))
+        return order
+
+    def _update_positions(self):
+        # Called with self.cond held; no I/O here
+        self.positions = {file_id: position
+                          for position, (file_id, *_) in enumerate(self._serving_order(), start=1)}
+
+    def _publish_positions(self, started=None):
+        """Stream every position that changed since it was last streamed, plus the start
+        message of the job just taken, in one round trip. Called without self.cond held."""
+        with self.announce_lock:
+            with self.cond:
+                positions = dict(self.positions)
+            batches = []
+            for file_id, position in positions.items():
+                if self.published.get(file_id) != position:
+                    self.published[file_id] = position
+                    batches.append((file_id, [f"⏳ Na fila de espera: posição {position}"]))
+            if started is not None:
+                self.published.pop(started, None)
+                batches.append((started, ["Iniciando testes..."]))
+            append_streams(batches)
+
+    def _next_job(self):
+        submitter, queue = next(iter(self.queues.items()))
+        job = queue.popleft()
+        # Move the submitter to the back of the rotation
+        del self.queues[submitter]
+        if queue:
+            self.queues[submitter] = queue
+        self.queued -= 1
+        self._update_positions()
+        return job
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.queued:
+                    self.cond.wait()
+                file_id, script_path, sandbox_dir, script_hash = self._next_job()
+
+            self._publish_positions(started=file_id)
+            try:
+                run_tests(file_id, script_path, sandbox_dir, script_hash)
+            except Exception as e:
+                append_stream(file_id, f"💥 Erro interno do avaliador: {e}")
+                append_stream(file_id, STREAM_DONE)
+                shutil.rmtree(sandbox_dir, ignore_errors=True)
+
+# Submissions graded at the same time by this process; their tests still share its test pool
+SUBMISSION_WORKERS = int(os.environ.get("SUBMISSION_WORKERS", max(1, PROCESS_TEST_WORKERS // 4)))
+SUBMISSION_QUEUE_SIZE = int(os.environ.get("SUBMISSION_QUEUE_SIZE", 200))
+MAX_QUEUED_PER_SUBMITTER = int(os.environ.get("MAX_QUEUED_PER_SUBMITTER", 3))
+
+submission_scheduler = SubmissionScheduler(SUBMISSION_WORKERS, SUBMISSION_QUEUE_SIZE, MAX_QUEUED_PER_SUBMITTER)
+
 @app.route('/stats')
 def stats():
-    conn = sqlite3.connect('stats.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
-    cursor.execute("SELECT status, COUNT(*) FROM test_results GROUP BY status")
+    # Rollups hold one row per (test, status), however many runs are stored
+    cursor.execute("SELECT status, SUM(runs) FROM test_rollups GROUP BY status")
     status_counts = dict(cursor.fetchall())
     
-    cursor.execute("SELECT test_name, AVG(execution_time) FROM test_results WHERE status='PASSED' GROUP BY test_name")
+    cursor.execute('''
+        SELECT test_name, total_time / runs,
+               CASE WHEN measured_runs > 0 THEN total_cpu_time / measured_runs END,
+               CASE WHEN measured_runs > 0 THEN total_max_rss / measured_runs END
+        FROM test_rollups WHERE status='PASSED' AND runs > 0 ORDER BY test_name
+    ''')
     avg_times = cursor.fetchall()
     
-    cursor.execute("SELECT COUNT(DISTINCT timestamp) FROM test_results")
-    total_submissions = cursor.fetchone()[0]
+    cursor.execute("SELECT value FROM stats_totals WHERE name = 'submission_count'")
+    row = cursor.fetchone()
+    total_submissions = row[0] if row else 0
     
     conn.close()
     
@@ -0,0 +1,150 @@
+"""Regrade a directory of submissions against the current test corpus.
+
+Run from the repository root, like the web app:
+
+    python3 regrade.py submissions/ --report regrade.csv
+
+Every (script, test) pair goes to the grader's shared test pool, so the whole
+batch keeps all of the pool's workers busy. Results are stored in stats.db like
+uploaded submissions. The report lists one row per test, as CSV or as JSON
+(chosen by the report's extension).
+"""
+
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+
+import main
+
+REPORT_FIELDS = ["script", "submission_id", "test", "status", "execution_time", "cpu_time", "max_rss", "note"]
+
+
+def find_scripts(directory, pattern):
+    return sorted(path for path in glob.glob(os.path.join(directory, pattern)) if os.path.isfile(path))
+
+
+def submit_script(path, test_cases):
+    """Queue every test of one script on the pool; returns its bookkeeping, or None if it is rejected."""
+    with open(path, "rb") as f:
+        raw = f.read()
+    if not main.is_script_safe(raw.decode("utf-8", errors="ignore")):
+        return None
+
+    file_id = str(uuid.uuid4())
+    started_at = main.db_timestamp()
+    start_time = time.perf_counter()
+    sandbox_dir, script_path = main.make_sandbox(file_id, raw)
+    policy = main.AbortPolicy(main.ABORT_AFTER_FAILURES, main.SUBMISSION_TIME_BUDGET,
+                              main.SKIP_HARDER_AFTER_TIMEOUT)
+    futures = [
+        (case, main.test_executor.submit(main.run_single_test, case, script_path, sandbox_dir, policy))
+        for case in test_cases if case.expected_output is not None
+    ]
+    return {
+        "file_id": file_id,
+        "script_hash": hashlib.sha256(raw).hexdigest(),
+        "sandbox_dir": sandbox_dir,
+        "started_at": started_at,
+        "start_time": start_time,
+        "futures": futures,
+    }
+
+
+def collect(job):
+    """Wait for a script's tests and store them in stats.db.
+
+    Returns its TestResult rows and a {test name: message} dict of the tests the
+    abort policy skipped, which are not stored."""
+    rows = []
+    skipped = {}
+    for case, future in job["futures"]:
+        status, messages, elapsed, usage, _ = future.result()
+        if status == 'SKIPPED':
+            skipped[case.name] = messages[-1].removeprefix(f"[{case.name}] ")
+        else:
+            rows.append(main.TestResult(case.name, status, elapsed, *(usage or (None, None, None))))
+    wall_time = time.perf_counter() - job["start_time"]
+    main.results_writer.record(
+        main.make_submission(job["file_id"], job["script_hash"], job["started_at"], wall_time, rows), rows)
+    shutil.rmtree(job["sandbox_dir"], ignore_errors=True)
+    return rows, skipped
+
+
+def report_rows(script, file_id, rows, skipped):
+    for row in rows:
+        cpu_time = row.user_time + row.sys_time if row.user_time is not None else None
+        yield {
+            "script": script,
+            "submission_id": file_id,
+            "test": row.test_name,
+            "status": row.status,
+            "execution_time": row.execution_time,
+            "cpu_time": cpu_time,
+            "max_rss": row.max_rss,
+            "note": None,
+        }
+    for test_name, message in skipped.items():
+        yield {field: None for field in REPORT_FIELDS} | {
+            "script": script,
+            "submission_id": file_id,
+            "test": test_name,
+            "status": "SKIPPED",
+            "note": message,
+        }
+
+
+def write_report(path, entries):
+    if path.endswith(".json"):
+        with open(path, "w") as f:
+            json.dump(entries, f, indent=2, ensure_ascii=False)
+        return
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(entries)
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Regrade a directory of submissions.")
+    parser.add_argument("directory", help="folder with the submitted scripts")
+    parser.add_argument("--pattern", default="*.py", help="which files to grade (default: *.py)")
+    parser.add_argument("--report", default="regrade.csv", help="report file, .csv or .json")
+    args = parser.parse_args(argv)
+
+    test_cases, _ = main.test_corpus.load()
+    test_cases = main.grading_cases(test_cases)
+    scripts = find_scripts(args.directory, args.pattern)
+    print(f"{len(scripts)} submissions x {len(test_cases)} tests on {main.PROCESS_TEST_WORKERS} workers")
+
+    start = time.perf_counter()
+    # Everything is queued up front so the pool never runs dry between scripts
+    jobs = [(path, submit_script(path, test_cases)) for path in scripts]
+
+    entries = []
+    for path, job in jobs:
+        script = os.path.basename(path)
+        if job is None:
+            print(f"{script}: rejected (potentially dangerous code)")
+            entries.append({field: None for field in REPORT_FIELDS}
+                           | {"script": script, "status": "REJECTED", "note": "código potencialmente perigoso"})
+            continue
+        rows, skipped = collect(job)
+        passed = sum(row.status == 'PASSED' for row in rows)
+        print(f"{script}: {passed}/{len(rows)} passed" + (f", {len(skipped)} skipped" if skipped else ""))
+        entries.extend(report_rows(script, job["file_id"], rows, skipped))
+
+    main.results_writer.flush()
+    write_report(args.report, entries)
+    print(f"Done in {time.perf_counter() - start:.1f}s, report written to {args.report}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())